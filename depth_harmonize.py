@@ -0,0 +1,283 @@
+"""
+Harmonize soil moisture and soil temperature sensors from each network onto
+a common set of soil layers.
+
+Each network's depth metadata is parsed into a structured depth index with
+one record per data column (label, variable, top and bottom depth in meters,
+and a unit scale and offset). A per-station weight matrix is then precomputed
+from the depth index, so that harmonizing a station's full (T,F) time series
+is a single matrix multiply. Layer values are the average over the layer of
+a depth profile that is piecewise-linear between sensor mid-depths, or equal
+to an interval sensor's value within the interval it measures.
+"""
+import re
+import pickle as pkl
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+
+## standard soil layers (top, bottom) in meters
+std_layers = ((0., .1), (.1, .4), (.4, 1.), (1., 2.))
+## harmonized variables; soil moisture in m^3/m^3 and soil temperature in C
+harmonized_vars = ("soilm", "tsoil")
+
+depth_dtype = np.dtype([
+    ("label", "U32"), ## data column label
+    ("var", "U16"), ## harmonized variable name, or "" if not harmonized
+    ("top", "f8"), ## top of the sensed interval (m below ground)
+    ("bottom", "f8"), ## bottom of the sensed interval (m below ground)
+    ("scale", "f8"), ## multiplier converting to harmonized units
+    ("offset", "f8"), ## added after scaling to convert to harmonized units
+    ])
+
+## variable names and unit (scale, offset) per network
+ismn_vars = {"soilm":("soilm", 1., 0.), "tsoil":("tsoil", 1., 0.)}
+uscrn_vars = {"vsm":("soilm", 1., 0.), "tsoil":("tsoil", 1., 0.)}
+## SCAN soil moisture is percent, and soil temperature is returned in the
+## stored unit of F unless get_scan requests otherwise
+scan_vars = {"SMS":("soilm", .01, 0.), "STO":("tsoil", 5/9, -32*5/9)}
+
+def parse_ismn_depths(labels:list, depths:list):
+    """
+    Depth index for an ISMN station pkl from extract_ismn, where labels are
+    formatted {var}_{depth_ix}_{sensor_ix} and depths lists the (d0, df)
+    interval of each (var, depth_ix) group in the order they first appear.
+    """
+    groups = {}
+    recs = []
+    for l in labels:
+        vk,dix,_ = l.rsplit("_", 2)
+        if (vk,dix) not in groups.keys():
+            groups[(vk,dix)] = len(groups)
+        d0,df = depths[groups[(vk,dix)]]
+        var,scale,offset = ismn_vars.get(vk, ("", 1., 0.))
+        recs.append((l, var, min(d0,df), max(d0,df), scale, offset))
+    return np.array(recs, dtype=depth_dtype)
+
+def parse_uscrn_depths(labels:list):
+    """
+    Depth index for USCRN fields like "vsm-5" or "tsoil-100" (depth in cm)
+    """
+    recs = []
+    for l in labels:
+        m = re.fullmatch(r"([a-z]+)-(\d+)", l)
+        if m is None or m.group(1) not in uscrn_vars.keys():
+            recs.append((l, "", np.nan, np.nan, 1., 0.))
+            continue
+        var,scale,offset = uscrn_vars[m.group(1)]
+        d = float(m.group(2))/100
+        recs.append((l, var, d, d, scale, offset))
+    return np.array(recs, dtype=depth_dtype)
+
+def parse_scan_depths(keys:list):
+    """
+    Depth index for SCAN REST element keys formatted
+    {elementCode}:{heightDepth}:{ordinal} by get_scan, where heightDepth is
+    in inches and negative below the surface, ie "SMS:-2:1". Elements
+    without a heightDepth have keys like "TAVG::1" or "TAVG:None:1".
+    """
+    recs = []
+    for k in keys:
+        code,hd,_ = (k.split(":") + ["",""])[:3]
+        if code not in scan_vars.keys() or hd in ("", "None"):
+            recs.append((k, "", np.nan, np.nan, 1., 0.))
+            continue
+        var,scale,offset = scan_vars[code]
+        d = abs(float(hd)) * .0254
+        recs.append((k, var, d, d, scale, offset))
+    return np.array(recs, dtype=depth_dtype)
+
+def _profile_weights(points, top, bottom):
+    """
+    (P,F) weights mapping F sensor values to a depth profile sampled at P
+    depths. Points within an interval sensor's range take the average of
+    the interval sensors covering them; other points are interpolated
+    linearly between sensor mid-depths, held constant beyond the
+    shallowest and deepest sensors.
+    """
+    P = points.size
+    mid = (top + bottom) / 2
+
+    ## linear interpolation between unique mid-depths, spreading weight
+    ## evenly across sensors that share a mid-depth
+    umid,inv = np.unique(mid, return_inverse=True)
+    counts = np.bincount(inv, minlength=umid.size)
+    k = np.clip(np.searchsorted(umid, points), 1, max(umid.size-1, 1))
+    if umid.size == 1:
+        wu = np.ones((P,1))
+    else:
+        z0,z1 = umid[k-1],umid[k]
+        frac = np.clip((points - z0) / (z1 - z0), 0., 1.)
+        wu = np.zeros((P,umid.size))
+        wu[np.arange(P),k-1] = 1 - frac
+        wu[np.arange(P),k] += frac
+    w = wu[:,inv] / counts[inv][None,:]
+
+    ## replace with interval sensor averages where intervals cover a point
+    is_interval = (bottom - top) > 1e-6
+    cover = (points[:,None] >= top[None,:]) & \
+            (points[:,None] <= bottom[None,:]) & is_interval[None,:]
+    ncover = np.count_nonzero(cover, axis=1)
+    m_cover = ncover > 0
+    w[m_cover] = cover[m_cover] / ncover[m_cover,None]
+    return w
+
+def layer_weights(depth_index, layers=std_layers, variables=harmonized_vars,
+        tolerance:float=.075, num_quad:int=32):
+    """
+    Precompute the weights that harmonize a station's data columns onto the
+    standard layers for each variable.
+
+    A layer is only estimated if it lies within the depth span of that
+    variable's sensors expanded by tolerance meters, so profiles are never
+    extrapolated far beyond the shallowest or deepest sensor.
+
+    :@param depth_index: structured depth_dtype array with a record per column
+    :@param layers: sequence of (top, bottom) layer bounds in meters
+    :@param variables: harmonized variables to produce layers for
+    :@param tolerance: distance (m) a layer may extend past the sensors
+    :@param num_quad: number of depths averaged per layer
+
+    :@return: dict with output "labels", "weights" (F,C) including unit scale,
+        "norm" (F,C) weights without the unit scale, "block" (2F,2C)
+        combining both, which is what harmonize multiplies against, and
+        "offset" (C,) unit offsets added to each layer after normalizing.
+    """
+    layers = np.asarray(layers, dtype=float)
+    F,L = len(depth_index),len(layers)
+    ## quadrature depths at cell centers within each layer, (L,Q)
+    q = (np.arange(num_quad) + .5) / num_quad
+    points = layers[:,:1] + q[None,:] * (layers[:,1:] - layers[:,:1])
+
+    labels = []
+    norm = np.zeros((F, L*len(variables)))
+    for vix,v in enumerate(variables):
+        labels += [f"{v}_{t*100:g}-{b*100:g}cm" for t,b in layers]
+        fixs = np.where((depth_index["var"]==v)
+                & np.isfinite(depth_index["top"])
+                & np.isfinite(depth_index["bottom"]))[0]
+        if fixs.size == 0:
+            continue
+        top = depth_index["top"][fixs]
+        bottom = depth_index["bottom"][fixs]
+        ## (L*Q,Fv) profile weights averaged over each layer's points
+        wp = _profile_weights(points.ravel(), top, bottom)
+        wl = wp.reshape(L, num_quad, fixs.size).mean(axis=1)
+        ## zero layers that would require extrapolating beyond the sensors
+        valid = (layers[:,0] >= np.amin(top) - tolerance) & \
+                (layers[:,1] <= np.amax(bottom) + tolerance)
+        wl[~valid] = 0.
+        norm[fixs, vix*L:(vix+1)*L] = wl.T
+
+    weights = norm * depth_index["scale"][:,None]
+    C = norm.shape[1]
+    ## weighted average of sensor unit offsets per layer, which is exact when
+    ## every sensor contributing to a layer has the same units
+    wsum = np.sum(norm, axis=0)
+    offset = np.where(wsum > 0, depth_index["offset"] @ norm /
+            np.where(wsum > 0, wsum, 1.), 0.)
+    block = np.zeros((2*F, 2*C))
+    block[:F,:C] = weights
+    block[F:,C:] = norm
+    return {"labels":labels, "layers":layers, "variables":tuple(variables),
+            "sensor_labels":list(depth_index["label"]), "weights":weights,
+            "norm":norm, "block":block, "offset":offset}
+
+def harmonize(data, harmonizer:dict, min_weight:float=.5):
+    """
+    Harmonize a station's (T,F) data onto the standard layers with a single
+    matrix multiply against the precomputed block weights.
+
+    Missing sensor values are excluded and the remaining weights for each
+    layer renormalized, so layers are NaN only where less than min_weight of
+    their total weight comes from valid sensor data. Unit offsets are added
+    after normalizing, so they don't depend on which sensors are valid.
+
+    :@param data: (T,F) array ordered like the depth index used for weights
+    :@param harmonizer: dict returned by layer_weights
+    :@param min_weight: minimum valid fraction of a layer's weight
+
+    :@return: (T,C) array of harmonized layer values
+    """
+    data = np.asarray(data, dtype=float)
+    m_valid = np.isfinite(data)
+    xm = np.concatenate([np.where(m_valid, data, 0.), m_valid], axis=-1)
+    out = xm @ harmonizer["block"]
+    C = len(harmonizer["labels"])
+    num,den = out[...,:C],out[...,C:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(den >= min_weight,
+                num / den + harmonizer["offset"], np.nan)
+
+def harmonize_station(etimes, sensor_labels:list, data, depth_index,
+        layers=std_layers):
+    """
+    Harmonize one station's data and return a dict ready to be stored,
+    including the weights so that the layer values can be traced back to
+    the sensors that they were derived from.
+    """
+    h = layer_weights(depth_index, layers=layers)
+    return {
+            "etimes":np.asarray(etimes),
+            "labels":h["labels"],
+            "layers":h["layers"],
+            "data":harmonize(data, h),
+            "sensor_labels":list(sensor_labels),
+            "weights":h["weights"],
+            }
+
+def scan_station_array(sdata:dict, keys:list=None):
+    """
+    Align the per-element time series of a get_scan station dict onto a
+    common sorted hourly time axis, with NaN where flags aren't valid ("V").
+
+    :@return: 3-tuple (etimes, keys, data) with (T,) epoch times and a
+        (T,F) data array ordered like keys
+    """
+    if keys is None:
+        keys = list(sdata.keys())
+    ## round each time to the nearest hour
+    htimes = [(np.asarray(sdata[k]["etimes"]) + 1800) // 3600 * 3600
+            for k in keys]
+    etimes = np.unique(np.concatenate(htimes)) if keys else np.zeros(0)
+    data = np.full((etimes.size, len(keys)), np.nan)
+    for i,(k,t) in enumerate(zip(keys,htimes)):
+        m = np.asarray(sdata[k]["flags"]) == "V"
+        data[np.searchsorted(etimes, t[m]), i] = sdata[k]["data"][m]
+    return etimes,keys,data
+
+if __name__=="__main__":
+    proj_root_dir = Path("/rhome/mdodson/soil-in-situ")
+    ismn_pkl_dir = Path("/rstor/mdodson/in-situ/ismn/station-pkls")
+    scan_pkl_dir = proj_root_dir.joinpath("data/scan/scan-pkls")
+    uscrn_combined_dir = proj_root_dir.joinpath(
+            "data/uscrn/uscrn-pkls-combined")
+    harmonized_dir = proj_root_dir.joinpath("data/harmonized-pkls")
+
+    for p in sorted(ismn_pkl_dir.glob("station_*.pkl")):
+        sd = pkl.load(p.open("rb"))
+        etimes = [int(datetime.strptime(t,"%Y%m%d%H").strftime("%s"))
+                for t in sd["times"]]
+        hd = harmonize_station(etimes, sd["labels"], sd["data"][:len(etimes)],
+                parse_ismn_depths(sd["labels"], sd["depths"]))
+        out_path = harmonized_dir.joinpath(
+                f"harmonized_ismn_{sd['network']}_{sd['station']}.pkl")
+        pkl.dump(hd, out_path.open("wb"))
+        print(f"Generated {out_path.as_posix()}")
+
+    for p in sorted(uscrn_combined_dir.glob("uscrn_*.pkl")):
+        pd = pkl.load(p.open("rb"))
+        keys = [k for k in pd.keys() if re.fullmatch(r"(vsm|tsoil)-\d+", k)]
+        hd = harmonize_station(pd["utc-datetime"], keys,
+                np.stack([pd[k] for k in keys], axis=-1),
+                parse_uscrn_depths(keys))
+        out_path = harmonized_dir.joinpath(f"harmonized_{p.stem}.pkl")
+        pkl.dump(hd, out_path.open("wb"))
+        print(f"Generated {out_path.as_posix()}")
+
+    for p in sorted(scan_pkl_dir.glob("scandata_*.pkl")):
+        etimes,keys,data = scan_station_array(pkl.load(p.open("rb")))
+        hd = harmonize_station(etimes, keys, data, parse_scan_depths(keys))
+        out_path = harmonized_dir.joinpath(f"harmonized_{p.stem}.pkl")
+        pkl.dump(hd, out_path.open("wb"))
+        print(f"Generated {out_path.as_posix()}")
@@ -5,17 +5,99 @@ import json
 from datetime import datetime,timedelta
 import pickle as pkl
 from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
 
 from ismn.interface import ISMN_Interface as ISMN
 
+from qc import qc_station,QC_MISSING
+from parse_cache import cache_key,load_cached,store_cached,evict_lru
+
+## bump whenever parse_ismn_stm output changes to invalidate cached parses
+ismn_parser_version = "1"
+
+## time-aligned ISMN and provider flags per value, keeping the leading flag
+## character like the per-sensor "-"-filled flag arrays
+flag_dtype = np.dtype([("ismn","S1"), ("provider","S1")])
+
 def _mp_preproc_station_data(args):
     return _preprocess_station_data(**args)
 
+def alloc_station_buffer(num_stations:int, t0:int, num_times:int,
+        num_sensors:int, mmap_path:Path=None, dtype="float32",
+        fill_value=np.nan):
+    """
+    Allocate a (station, time, sensor) array that pool workers can write
+    station data into directly, so that only offsets and metadata need to be
+    returned to the parent process.
+
+    :@param num_stations: Size of the station axis
+    :@param t0: Epoch time of the first hourly step on the time axis
+    :@param num_times: Number of hourly steps on the time axis
+    :@param num_sensors: Maximum number of sensors per station
+    :@param mmap_path: If provided, the buffer is a numpy memory map at this
+        path rather than a multiprocessing.shared_memory block
+    :@param dtype: numpy data type of the buffer, which may be structured
+    :@param fill_value: initial value of every element, ie NaN for data,
+        QC_MISSING for a QC mask buffer, or ("-","-") for a flag_dtype buffer
+
+    :@return: 3-tuple (array, buffer_info, shm) where buffer_info is the
+        picklable dict passed to workers, and shm is the SharedMemory object
+        (None for memory maps) which the parent must close and unlink
+    """
+    shape = (num_stations, num_times, num_sensors)
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    print(f"Allocating {nbytes/1024**3:.2f} GB {dtype} station buffer " + \
+            ("in shared memory" if mmap_path is None else f"at {mmap_path}"))
+    ## structured dtypes need their field descriptions to be reconstructed
+    buffer_info = {"shape":shape, "t0":int(t0),
+            "dtype":dtype.descr if dtype.names else dtype.str,
+            "shm_name":None, "mmap_path":None}
+    if mmap_path is None:
+        shm = SharedMemory(create=True, size=max(nbytes, 1))
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        buffer_info["shm_name"] = shm.name
+    else:
+        shm = None
+        arr = np.lib.format.open_memmap(
+                Path(mmap_path), mode="w+", dtype=dtype, shape=shape)
+        buffer_info["mmap_path"] = Path(mmap_path).as_posix()
+    ## fill one station at a time to limit resident pages of memory maps
+    for i in range(num_stations):
+        arr[i] = fill_value
+    return arr,buffer_info,shm
+
+def _attach_station_buffer(buffer_info:dict):
+    """
+    Open the array described by a buffer_info dict from alloc_station_buffer
+    within a worker process. Returns (array, shm) where shm must be closed by
+    the caller (but not unlinked) if it isn't None.
+    """
+    if buffer_info["shm_name"] is not None:
+        shm = SharedMemory(name=buffer_info["shm_name"])
+        arr = np.ndarray(buffer_info["shape"],
+                dtype=np.dtype(buffer_info["dtype"]), buffer=shm.buf)
+        return arr,shm
+    arr = np.load(buffer_info["mmap_path"], mmap_mode="r+")
+    assert arr.shape == tuple(buffer_info["shape"])
+    return arr,None
+
 def _preprocess_station_data(station_dict:dict, var_mapping:dict,
-        station_pkl_dir:Path):
+        station_pkl_dir:Path, station_buffer:dict=None, station_ix:int=None,
+        qc_buffer:dict=None, flag_buffer:dict=None, parse_cache_dir:Path=None):
     """
     for each station, make a dict containing all information for each sensor,
     including parsed value and flag data, and store it in a pkl file
+
+    If station_buffer (a buffer_info dict from alloc_station_buffer) and
+    station_ix are provided, the data array is instead written directly into
+    the parent's shared (station, time, sensor) buffer along its common time
+    axis, the QC mask and time-aligned ISMN flags are written to the same
+    offsets of qc_buffer and flag_buffer, and only the station metadata and
+    time offsets are returned rather than being stored in a pkl.
+
+    If parse_cache_dir is provided, parsed sensor files are shared through a
+    parse_cache directory so unchanged stm files are only parsed once.
     """
     stn = station_dict
     ssr_dict = {}
@@ -32,6 +114,7 @@ def _preprocess_station_data(station_dict:dict, var_mapping:dict,
                     stm_path=ismn_stations_path.joinpath(ssr["file"]),
                     return_epoch_times=True,
                     debug=False,
+                    cache_dir=parse_cache_dir,
                     ))
                 },
             })
@@ -78,13 +161,16 @@ def _preprocess_station_data(station_dict:dict, var_mapping:dict,
                 tmp_iflags[all_times[tk]] = ismn_flags[i]
                 if not src_flags is None:
                     tmp_sflags[all_times[tk]] = src_flags[i]
-            data_dict[vk].append((tmp_array, (ismn_flags,src_flags)))
+            data_dict[vk].append((tmp_array, (ismn_flags,src_flags),
+                (tmp_iflags,tmp_sflags)))
 
     ## collect all depths and sensors per depth into a single dict
     adata = []
     alabels = []
     amasks = []
+    aflags = []
     adepths = []
+    ldepths = []
     aduplicates = []
     sensors = {}
     times = list(sorted(all_times.keys()))
@@ -106,13 +192,30 @@ def _preprocess_station_data(station_dict:dict, var_mapping:dict,
             for nix,(six,ssr) in enumerate(depth_members):
                 skey = f"{vk}_{dix:02}_{nix:02}"
                 alabels.append(skey)
+                ldepths.append(np.average(ssr["depth"]))
                 adata.append(data_dict[vk][six][0])
                 amasks.append(data_dict[vk][six][1])
+                aflags.append(data_dict[vk][six][2])
                 sensors[skey] = stn["sensors"][six]
                 if vk in duplicates.keys():
                     if six in duplicates[vk].keys():
                         aduplicates.append(duplicates[vk][six])
 
+    ## range, rate, flat-line and frozen soil QC using sensor mid-depths
+    data = np.stack(adata, axis=-1)
+    qc_mask = qc_station(
+            data,
+            labels=alabels,
+            depths=ldepths,
+            )
+
+    ## (T,F) time-aligned ISMN and provider flags, "-" where not reported
+    flags = np.full(data.shape, (b"-",b"-"), dtype=flag_dtype)
+    for fix,(iflags,sflags) in enumerate(aflags):
+        flags["ismn"][:,fix] = np.char.encode(iflags)
+        if sflags is not None:
+            flags["provider"][:,fix] = np.char.encode(sflags)
+
     network_name = stn["network"].replace(".","")
     station_name = stn["station"].replace(".","")
     station_pkl_dict = {
@@ -131,17 +234,78 @@ def _preprocess_station_data(station_dict:dict, var_mapping:dict,
             "times":times,
             ## all ordered according to the sensor labels labels
             "labels":alabels,
-            "data":np.stack(adata, axis=-1),
+            "data":data,
             "masks":amasks,
+            ## (T,F) flag_dtype array of time-aligned ISMN and provider flags
+            "flags":flags,
+            ## (T,F) uint8 QC bit mask from qc.qc_station; 0 where valid
+            "qc":qc_mask,
             "duplicate_times":aduplicates,
             }
     print(network_name, station_name, alabels)
+
+    if station_buffer is not None:
+        return _write_station_buffer(station_pkl_dict, station_buffer,
+                qc_buffer, flag_buffer, station_ix)
+
     pkl_path = station_pkl_dir.joinpath(
             f"station_{network_name}_{station_name}.pkl")
     pkl.dump(station_pkl_dict, pkl_path.open("wb"))
     return pkl_path
 
-def parse_ismn_stm(stm_path:Path, return_epoch_times=False, debug=False):
+def _write_station_buffer(station_pkl_dict:dict, buffer_info:dict,
+        qc_buffer_info:dict, flag_buffer_info:dict, station_ix:int):
+    """
+    Write a station's (T,F) data, QC mask, and time-aligned flags into its
+    slot of the shared data, QC, and flag buffers, aligned to the buffers'
+    hourly time axis, and return the station metadata with the per-value
+    arrays replaced by the buffer offsets they were written to.
+    """
+    sd = station_pkl_dict
+    ## data arrays have a trailing step beyond the last listed time
+    nt = len(sd["times"])
+    nf = sd["data"].shape[-1]
+    _,buf_nt,buf_nf = buffer_info["shape"]
+    if nf > buf_nf:
+        raise ValueError(f"{sd['network']} {sd['station']} has {nf} "
+                f"sensors; buffer only fits {buf_nf}")
+    st0 = int(datetime.strptime(sd["times"][0], "%Y%m%d%H").strftime("%s"))
+    t_start = (st0 - buffer_info["t0"]) // 3600
+    ## clip the station's time range to the buffer time axis
+    d0,d1 = max(0, -t_start), min(nt, buf_nt - t_start)
+    if d0 > 0 or d1 < nt:
+        print(f"Clipping {sd['network']} {sd['station']} to buffer times")
+    for info,src in ((buffer_info, sd["data"]), (qc_buffer_info, sd["qc"]),
+            (flag_buffer_info, sd["flags"])):
+        if info is None:
+            continue
+        arr,shm = _attach_station_buffer(info)
+        try:
+            if d1 > d0:
+                arr[station_ix, t_start+d0:t_start+d1, :nf] = src[d0:d1]
+            if isinstance(arr, np.memmap):
+                arr.flush()
+        finally:
+            del arr
+            if shm is not None:
+                shm.close()
+    ## per-value arrays are in the buffers, so only metadata is returned
+    meta = {k:v for k,v in sd.items()
+            if k not in ("data","qc","flags","masks")}
+    meta.update({
+        ## first axis index of this station in the buffers
+        "station_ix":station_ix,
+        ## slice of the buffer time axis that holds valid station data
+        "time_slice":(t_start+d0, max(t_start+d0, t_start+d1)),
+        ## station times that fell within the buffer time axis
+        "times":sd["times"][d0:max(d0,d1)],
+        ## number of sensors filled along the last axis
+        "num_sensors":nf,
+        })
+    return meta
+
+def parse_ismn_stm(stm_path:Path, return_epoch_times=False, debug=False,
+        cache_dir:Path=None):
     """
     Extract instrument file time series from files following the ISMN format
 
@@ -150,6 +314,9 @@ def parse_ismn_stm(stm_path:Path, return_epoch_times=False, debug=False):
         rather than a list of datetime objects corresponding to each timestep
     :@param debug: If True, return information on sample count and time
         interval consistency for the file.
+    :@param cache_dir: If provided, parsed arrays are loaded from or stored
+        in this parse_cache directory, keyed by the file's path, size, and
+        modification time alongside ismn_parser_version.
 
     :@return: 3-tuple (header_dict, data_values, times) Where header_dict
         contains the CSE, network, and station id, station location, and
@@ -158,23 +325,53 @@ def parse_ismn_stm(stm_path:Path, return_epoch_times=False, debug=False):
     stm_path = Path(stm_path)
     assert stm_path.exists()
 
-    ## header labels
-    hlabels = ["cseid", "network", "station", "lat", "lon", "elev", "d0", "df"]
-    ## header fields that should be converted to float
-    ffields = ["lat", "lon", "elev", "d0", "df"]
-    ## parse the header as a dict
-    lines = stm_path.open("r").readlines()
-    hline = [v for v in lines[0].replace("\n","").split(" ") if v]
-    sensor_info = " ".join(hline[len(hlabels):])
-    hline = hline[:len(hlabels)]
-    hdict = {l:v if l not in ffields else float(v)
-            for l,v in zip(hlabels,hline)}
-    hdict["sensor_info"] = sensor_info
-
-    ## read the lines, skipping the header
-    date,time,values,*flags = zip(*map(
-        lambda l:l.replace("\n","").split(" "), lines[1:]
-        ))
+    cached = None
+    if cache_dir is not None:
+        ckey = cache_key(stm_path, ismn_parser_version)
+        cached = load_cached(cache_dir, ckey)
+
+    if cached is not None:
+        hdict = json.loads(str(cached["header"]))
+        values = cached["values"]
+        flags = [tuple(f) for f in cached["flags"].tolist()]
+        datetimes = cached["datetimes"].tolist()
+        etimes = cached["etimes"]
+    else:
+        ## header labels
+        hlabels = ["cseid", "network", "station", "lat", "lon", "elev",
+                "d0", "df"]
+        ## header fields that should be converted to float
+        ffields = ["lat", "lon", "elev", "d0", "df"]
+        ## parse the header as a dict
+        lines = stm_path.open("r").readlines()
+        hline = [v for v in lines[0].replace("\n","").split(" ") if v]
+        sensor_info = " ".join(hline[len(hlabels):])
+        hline = hline[:len(hlabels)]
+        hdict = {l:v if l not in ffields else float(v)
+                for l,v in zip(hlabels,hline)}
+        hdict["sensor_info"] = sensor_info
+
+        ## read the lines, skipping the header
+        date,time,values,*flags = zip(*map(
+            lambda l:l.replace("\n","").split(" "), lines[1:]
+            ))
+
+        ## extract datetimes and convert to epoch times
+        datetimes = [datetime.strptime(" ".join(tt), "%Y/%m/%d %H:%M")
+                for tt in zip(date,time) ]
+        etimes = np.asarray([float(t.strftime("%s")) for t in datetimes])
+
+        ## convert values to a float array
+        values = np.asarray([float(v) for v in values])
+
+        if cache_dir is not None:
+            store_cached(cache_dir, ckey, {
+                "header":np.asarray(json.dumps(hdict)),
+                "values":values,
+                "flags":np.asarray(flags, dtype=str),
+                "datetimes":np.asarray(datetimes, dtype="datetime64[m]"),
+                "etimes":etimes,
+                })
 
     ## separate the flag columns if there are more than 1
     if len(flags) == 2:
@@ -185,19 +382,11 @@ def parse_ismn_stm(stm_path:Path, return_epoch_times=False, debug=False):
     else:
         raise ValueError(f"Why are there more than 3 flag columns? >:(", flags)
 
-    ## extract datetimes and convert to epoch times
-    datetimes = [datetime.strptime(" ".join(tt), "%Y/%m/%d %H:%M")
-            for tt in zip(date,time) ]
-    etimes = np.asarray([float(t.strftime("%s")) for t in datetimes])
-
     ## if debugging print sample size and time interval consistency
     if debug:
         dt = np.diff(etimes)
         print(f"{etimes.size = } {np.amin(dt)}, {np.amax(dt)}, {np.average(dt)}, {np.count_nonzero(dt < 3599)}, {np.count_nonzero(dt > 3601)}")
 
-    ## convert values to a float array
-    values = np.asarray([float(v) for v in values])
-
     return [hdict,values,(flags_ismn,flags_provider),datetimes] + \
             [[],[etimes]][return_epoch_times]
 
@@ -208,6 +397,20 @@ if __name__=="__main__":
     ismn_stations_path = proj_data_dir.joinpath("station-data")
     ismn_available_json = proj_root_dir.joinpath("data/ismn-datamenu.json")
     station_pkl_dir = proj_data_dir.joinpath("station-pkls")
+    ## If True, workers write into shared (station, time, sensor) data, QC,
+    ## and flag buffers that are stored as merged npy files rather than pkls
+    use_station_buffer = False
+    ## By default the buffers are memory-mapped directly at the merged npy
+    ## paths, since all stations over the full time span can be tens of GB.
+    ## If False they are held in shared memory and saved after extraction.
+    station_buffer_mmap = True
+    merged_npy_path = proj_data_dir.joinpath("ismn_merged_data.npy")
+    merged_qc_path = proj_data_dir.joinpath("ismn_merged_qc.npy")
+    merged_flag_path = proj_data_dir.joinpath("ismn_merged_flags.npy")
+    merged_meta_path = proj_data_dir.joinpath("ismn_merged_meta.pkl")
+    ## directory of cached stm parses, and its disk budget in bytes
+    parse_cache_dir = proj_data_dir.joinpath("stm-parse-cache")
+    parse_cache_max_bytes = 32 * 1024**3
 
     ## subset of sensor networks to utilize
     extract_networks = ["TxSON", "SOILSCAPE", "SNOTEL", "SCAN", "RISMA",
@@ -271,16 +474,76 @@ if __name__=="__main__":
                 "station":stn,
                 "sensors":ismn_dm[ntw][stn]["sensors"],
                 "location":ismn_dm[ntw][stn]["location"],
-                "station_meta":ismn_dm[ntw][stn]["station_meta"]
+                "station_meta":ismn_dm[ntw][stn]["station_meta"],
+                "time_range":ismn_dm[ntw][stn]["time_range"],
                 })
 
     args = [{
         "station_dict":s,
         "var_mapping":var_mapping,
         "station_pkl_dir":station_pkl_dir,
+        "parse_cache_dir":parse_cache_dir,
         } for s in stations
         ]
     nworkers = 15
-    with Pool(nworkers) as pool:
-        for ppath in pool.imap_unordered(_mp_preproc_station_data, args):
-            print(f"generated {ppath.name}")
+    if not use_station_buffer:
+        with Pool(nworkers) as pool:
+            for ppath in pool.imap_unordered(_mp_preproc_station_data, args):
+                print(f"generated {ppath.name}")
+    else:
+        ## common hourly time axis spanning every station's time range
+        trange = [t for s in stations for t in s["time_range"] if t is not None]
+        t0 = (min(trange) // 3600) * 3600
+        ntimes = (max(trange) - t0) // 3600 + 1
+        nsensors = max(len(s["sensors"]) for s in stations)
+        buffers = {}
+        merged_paths = {"data":merged_npy_path, "qc":merged_qc_path,
+                "flags":merged_flag_path}
+        for k,dtype,fill in (
+                ("data", "float32", np.nan),
+                ("qc", "uint8", QC_MISSING),
+                ("flags", flag_dtype, (b"-",b"-"))):
+            buffers[k] = alloc_station_buffer(
+                    num_stations=len(stations),
+                    t0=t0,
+                    num_times=ntimes,
+                    num_sensors=nsensors,
+                    mmap_path=[None,merged_paths[k]][station_buffer_mmap],
+                    dtype=dtype,
+                    fill_value=fill,
+                    )
+        for i,a in enumerate(args):
+            a.update({
+                "station_buffer":buffers["data"][1],
+                "qc_buffer":buffers["qc"][1],
+                "flag_buffer":buffers["flags"][1],
+                "station_ix":i,
+                })
+        try:
+            metas = [None for s in stations]
+            with Pool(nworkers) as pool:
+                for m in pool.imap_unordered(_mp_preproc_station_data, args):
+                    metas[m["station_ix"]] = m
+                    print(f"wrote {m['network']} {m['station']} to buffer")
+            for k,npy_path in merged_paths.items():
+                arr,_,shm = buffers[k]
+                ## memory maps are already stored at the npy paths
+                if shm is None:
+                    arr.flush()
+                else:
+                    np.save(npy_path, arr)
+            pkl.dump({"t0":t0, "stations":metas},
+                    merged_meta_path.open("wb"))
+        finally:
+            ## drop array views of shared memory so the blocks can be closed
+            arr = None
+            for k in list(buffers.keys()):
+                shm = buffers.pop(k)[2]
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+    ## drop the least recently used parses beyond the cache's disk budget
+    if parse_cache_dir.exists():
+        freed = evict_lru(parse_cache_dir, parse_cache_max_bytes)
+        print(f"evicted {freed/1024**2:.1f} MB from {parse_cache_dir}")
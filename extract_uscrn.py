@@ -13,6 +13,9 @@ import json
 from datetime import datetime
 import pickle as pkl
 
+from static_soils import load_uscrn_soils,uscrn_key_from_path,station_indices
+from qc import qc_station,qc_valid,valid_window_starts
+
 fields = [
         ("wbanno", slice(0,5)), ## station number
         ("utc-datetime", slice(6,19)), ## "YYYYmmdd HHMM"
@@ -95,6 +98,7 @@ if __name__=="__main__":
     combined_pkl_dir = proj_root_dir.joinpath("data/uscrn/uscrn-pkls-combined")
     init_idx_json = proj_root_dir.joinpath(
             "data/uscrn-valid-init-idxs_48hr.json")
+    soils_csv = proj_root_dir.joinpath("data/uscrn-station-soils.csv")
     skip_existing = False
     contiguous_window_min_size = 48 ## must have this number contiguous hours
     min_spacing_hours = 17 ## sample start times must be separated
@@ -160,31 +164,37 @@ if __name__=="__main__":
     cwdw = contiguous_window_min_size
     '''
     fkeys = [f[0] for f in fields]
+    qc_keys = [k for k in fkeys if k not in ("utc-datetime", *str_fields)]
     valid_init_ixs = {}
     for tmpp in combined_pkl_dir.iterdir():
         pd = pkl.load(tmpp.open("rb"))
-        masks = []
-        for k in fkeys:
-            if k=="utc-datetime":
-                tdiffs = np.diff(pd[k])
-                m_contig = (tdiffs-3600)**2 < 100
-            elif k in str_fields:
-                continue
-            masks.append(np.isfinite(pd[k]))
-            m_all = np.all(np.stack(masks, axis=1), axis=1)
+        tdiffs = np.diff(pd["utc-datetime"])
+        m_contig = (tdiffs-3600)**2 < 100
+        ## physical range, rate, flat-line, and frozen soil QC on all columns
+        qc_mask = qc_station(
+                np.stack([pd[k] for k in qc_keys], axis=-1),
+                labels=qc_keys,
+                times=pd["utc-datetime"],
+                )
+        m_all = np.all(qc_valid(qc_mask), axis=1)
         print(f"{np.count_nonzero(m_all):<6}",tmpp.as_posix())
-        valid_init_ixs[tmpp.name] = []
-        for ix in range(0, m_contig.size-cwdw):
-            if np.all(m_contig[ix:ix+cwdw]) & np.all(m_all[ix:ix+cwdw+1]):
-                valid_init_ixs[tmpp.name].append(ix)
+        valid_init_ixs[tmpp.name] = valid_window_starts(
+                m_all, cwdw, m_contig).tolist()
     json.dump(valid_init_ixs, init_idx_json.open("w"))
     '''
 
     ## Extract valid sequences to time series samples padded by a provided
     ## minimum number of hours and concatenate them all in a single sample pkl.
+    ## Static soil properties aren't copied into samples; each sample instead
+    ## references its station's row in the static table, which is stored once
     #'''
     valid_init_ixs = json.load(init_idx_json.open("r"))
     cpkl_names = list(valid_init_ixs.keys())
+    static = load_uscrn_soils(soils_csv)
+    ## static table row per combined pkl, -1 if the locale has no soil data
+    pkl_static_ixs = station_indices(
+            static, [uscrn_key_from_path(pk) for pk in cpkl_names])
+    static_ix = []
     strdata = []
     fdata = []
     times = []
@@ -218,14 +228,18 @@ if __name__=="__main__":
         times.append(np.stack(tmp_times, axis=0)) ## (N, W)
         strdata.append(tmp_strdata) ## (N, W, Fs)
         sflag.append(tmp_sflag) ## (N,)
+        static_ix.append(np.full(len(tmp_fdata), pkl_static_ixs[pi])) ## (N,)
         print(f"Extracted {len(tmp_fdata)} samples from {pk}")
 
     fdata = np.concatenate(fdata, axis=0)
     times = np.concatenate(times, axis=0)
     sflag = np.concatenate(sflag, axis=0)
+    static_ix = np.concatenate(static_ix, axis=0)
 
-    labels = (fkeys, str_fields, cpkl_names)
-    data = (fdata, strdata, sflag, times)
+    ## static table (S,F) data is gathered per batch with
+    ## static_soils.gather_static using each sample's static_ix
+    labels = (fkeys, str_fields, cpkl_names, static["labels"])
+    data = (fdata, strdata, sflag, times, static_ix, static["data"])
     pkl_path = proj_root_dir.joinpath(
             f"data/uscrn_samples_{cwdw}h_{min_spacing_hours}p.pkl")
     pkl.dump((labels,data), pkl_path.open("wb"))
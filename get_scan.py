@@ -9,6 +9,12 @@ import json
 from datetime import datetime
 import pickle as pkl
 
+from static_soils import load_uscrn_soils
+from station_match import ismn_stations,scan_rest_stations,uscrn_stations
+from station_match import build_station_index,match_stations
+from station_match import covered_ranges,uncovered_ranges,merge_ranges
+from station_match import scan_element_ranges
+
 base_url = "https://wcc.sc.egov.usda.gov/awdbRestApi/services/v1"
 
 def get_data_menu():
@@ -30,8 +36,14 @@ def get_data_menu():
             "units":{d["code"]:d for d in rj["units"]},
             }
 
-def get_stations_menu():
-    r = requests.get(base_url + "/stations")
+def get_stations_menu(return_elements=False):
+    """
+    Dict of REST station dicts keyed by station triplet. If return_elements,
+    each station includes its "stationElements" list of reported elements
+    along with their durations and periods of record.
+    """
+    r = requests.get(base_url + "/stations?returnStationElements=" + \
+            ["false","true"][return_elements])
     try:
         assert r.status_code == 200
     except:
@@ -97,16 +109,47 @@ def get_station_data(
                 }
     return sdata
 
+def merge_station_data(*sdatas):
+    """
+    Combine station dicts from get_station_data covering different time
+    ranges into a single dict with time-sorted data per feature
+    """
+    merged = {}
+    for sd in sdatas:
+        for k,d in sd.items():
+            if k not in merged.keys():
+                merged[k] = {"finfo":d["finfo"], "data":[], "etimes":[],
+                        "flags":[]}
+            merged[k]["data"].append(np.asarray(d["data"]))
+            merged[k]["etimes"] += list(d["etimes"])
+            merged[k]["flags"].append(np.asarray(d["flags"]))
+    for k,d in merged.items():
+        ## sort by time, keeping the first of any times repeated at the
+        ## shared boundary of adjacent requests
+        _,order = np.unique(d["etimes"], return_index=True)
+        d["data"] = np.concatenate(d["data"])[order]
+        d["flags"] = np.concatenate(d["flags"])[order]
+        d["etimes"] = [d["etimes"][i] for i in order]
+    return merged
+
 if __name__=="__main__":
     proj_root_dir = Path("/Users/mtdodson/desktop/soilm-in-situ")
     station_json_path = proj_root_dir.joinpath("scan-stations.json")
     datamenu_json_path = proj_root_dir.joinpath("scan-datamenu.json")
+    ## elements and time ranges requested per station, including requests
+    ## that returned no data, so they aren't requested on every run
+    request_log_path = proj_root_dir.joinpath("scan-request-log.json")
     pkl_dir = proj_root_dir.joinpath("station-pkls")
+    ## locally available data from other sources that may duplicate SCAN
+    ismn_datamenu_path = proj_root_dir.joinpath("ismn-datamenu.json")
+    ismn_pkl_dir = proj_root_dir.joinpath("ismn-station-pkls")
+    uscrn_soils_csv = proj_root_dir.joinpath("uscrn-station-soils.csv")
+    uscrn_combined_dir = proj_root_dir.joinpath("uscrn-pkls-combined")
 
     ## determine which features to extract if available
     extract_feats = [
             "TAVG", "PRES", "DPTP", "PREC", "PRCP", "LWINV", "SWINV", "WTEQ",
-            "WDIR", "WSPDV", "SMS", "SMV", "SMX", "SMN",
+            "WDIR", "WSPDV", "SMS", "SMV", "SMX", "SMN", "STO",
 
             #"TMAX", "TMIN", "HFTV", "EVAP", "TGSV",
             #"NTRDV", "NTRDX", "NTRDN", "PTEMP",
@@ -114,16 +157,22 @@ if __name__=="__main__":
             #"SNWDX", "SNWDN", "SNRR", "STV", "STX", "STN", "SRAD", "SRADV",
             #"SRADX", "SRADN", "SRMV", "SRMX", "SRMN", "WSPDX", "WSPDN",
             ]
+    ## elements extract_scan requires in every SCAN pkl (see require_feats),
+    ## which are always downloaded even if a duplicate station covers them
+    scan_required = ["DPTP", "PRCP", "SMS", "TAVG", "WSPDV"]
     begin_date = datetime(2018, 1, 1)
     end_date = datetime(2024, 1, 1)
     skip_existing = True
 
-    ## get the REST API parameters for stations and data types
-    if not station_json_path.exists():
-        smenu = get_stations_menu()
-        json.dump(smenu, station_json_path.open("w"))
-    else:
+    ## get the REST API parameters for stations and data types. Menus cached
+    ## without each station's element list are requested again.
+    smenu = None
+    if station_json_path.exists():
         smenu = json.loads(station_json_path.open("r").read())
+    if smenu is None or any("stationElements" not in v
+            for v in smenu.values()):
+        smenu = get_stations_menu(return_elements=True)
+        json.dump(smenu, station_json_path.open("w"))
     if not datamenu_json_path.exists():
         dmenu = get_data_menu()
         json.dump(dmenu, datamenu_json_path.open("w"))
@@ -140,22 +189,85 @@ if __name__=="__main__":
         if smenu[s]["networkCode"] == "SCAN":
             scan.append(s)
     smenu = {k:v for k,v in smenu.items() if smenu[k]["networkCode"]=="SCAN"}
+
+    request_log = {}
+    if request_log_path.exists():
+        request_log = json.load(request_log_path.open("r"))
+
+    ## index SCAN stations alongside local ISMN and USCRN stations so that
+    ## only time ranges not already covered by a duplicate are requested.
+    ## existing station pkls and previous requests only count as coverage
+    ## when skipping existing
+    records = [scan_rest_stations(
+        smenu,
+        scan_pkl_dir=[None,pkl_dir][skip_existing],
+        request_log=[None,request_log][skip_existing],
+        )]
+    if ismn_datamenu_path.exists():
+        records.append(ismn_stations(
+            json.load(ismn_datamenu_path.open("r")),
+            station_pkl_dir=ismn_pkl_dir,
+            ))
+    if uscrn_soils_csv.exists():
+        records.append(uscrn_stations(
+            load_uscrn_soils(uscrn_soils_csv),
+            combined_pkl_dir=uscrn_combined_dir,
+            ))
+    sindex = build_station_index(*records)
+    matches = match_stations(sindex)
+    req_t0 = int(begin_date.strftime("%s"))
+    req_tf = int(end_date.strftime("%s"))
+
     for s in smenu.keys():
         pkl_path = pkl_dir.joinpath(f"scandata_{s.replace(':','-')}.pkl")
-        if pkl_path.exists() and skip_existing:
-            print(f"Skipping existing file: {pkl_path.as_posix()}")
-            continue
-        try:
-            sdata = get_station_data(
-                    station_triplet=s,
-                    features=extract_feats,
-                    begin_date=begin_date,
-                    end_date=end_date,
-                    duration="HOURLY",
-                    return_flags=True,
-                    )
-        except ValueError as e:
-            print(e)
+        six = sindex["ix"][("scan", s)]
+        dups = [sindex["ids"][i] for i in np.where(matches[six])[0]]
+        ## hourly period of record per element the station reports
+        selems = scan_element_ranges(smenu[s], duration="HOURLY")
+        ## group elements that are missing over the same time ranges so
+        ## each distinct set of gaps is a single request per range
+        gap_feats = {}
+        for f in extract_feats:
+            ## elements the station doesn't report aren't gaps
+            if selems is not None and f not in selems.keys():
+                continue
+            por = [(req_t0, req_tf)] if selems is None else selems[f]
+            covered = covered_ranges(sindex, matches, six, f,
+                    duplicates=f not in scan_required)
+            gaps = tuple(g for t0,tf in por
+                    if min(tf, req_tf) > max(t0, req_t0)
+                    for g in uncovered_ranges(
+                        max(t0, req_t0), min(tf, req_tf), covered))
+            if len(gaps) > 0:
+                gap_feats[gaps] = gap_feats.get(gaps, []) + [f]
+        if len(gap_feats)==0:
+            print(f"Skipping covered station {s} (duplicates: {dups})")
             continue
-        pkl.dump(sdata, pkl_path.open("wb"))
-        print(f"Generated {pkl_path.as_posix()}")
+        sdatas = []
+        if pkl_path.exists() and skip_existing:
+            sdatas.append(pkl.load(pkl_path.open("rb")))
+        slog = request_log.setdefault(s, {})
+        for gaps,feats in gap_feats.items():
+            for t0,tf in gaps:
+                try:
+                    sdatas.append(get_station_data(
+                            station_triplet=s,
+                            features=feats,
+                            begin_date=datetime.fromtimestamp(t0),
+                            end_date=datetime.fromtimestamp(tf),
+                            duration="HOURLY",
+                            return_flags=True,
+                            ))
+                except ValueError as e:
+                    print(e)
+                    ## failed requests are retried, but empty ones are not
+                    if not str(e).startswith("No data found"):
+                        continue
+                for f in feats:
+                    slog[f] = merge_ranges(
+                            [tuple(r) for r in slog.get(f, [])] + [(t0, tf)])
+        if len(sdatas) > 0:
+            pkl.dump(merge_station_data(*sdatas), pkl_path.open("wb"))
+            print(f"Generated {pkl_path.as_posix()}")
+        ## only log requests once their data is stored
+        json.dump(request_log, request_log_path.open("w"))
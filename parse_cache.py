@@ -0,0 +1,92 @@
+"""
+Persistent cache of parsed raw sensor files, so that re-running extraction
+skips text parsing for files that haven't changed.
+
+Entries are uncompressed npz files of numpy arrays named by a hash of the
+source file's absolute path, size, modification time, and a parser version
+string, so editing a file or bumping the parser version invalidates its
+entry. Entries are written to a temporary file and atomically renamed, and
+readers tolerate entries disappearing, so one cache directory can be shared
+by pool workers. Reads refresh an entry's modification time, which evict_lru
+uses to delete the least recently used entries beyond a disk budget.
+"""
+import os
+import uuid
+import zipfile
+import hashlib
+from pathlib import Path
+import numpy as np
+
+def cache_key(src_path:Path, version:str):
+    """
+    Unique key for the current state of a source file and parser version
+
+    :@param src_path: Path to the raw file that is being parsed
+    :@param version: String identifying the parser; change it whenever the
+        parsed output format or logic changes
+    """
+    src_path = Path(src_path).resolve()
+    st = src_path.stat()
+    ident = f"{src_path.as_posix()}|{st.st_size}|{st.st_mtime_ns}|{version}"
+    return hashlib.sha1(ident.encode("utf-8")).hexdigest()
+
+def load_cached(cache_dir:Path, key:str):
+    """
+    Load the dict of arrays stored for a key, or None if there is no valid
+    entry. Successful reads mark the entry as recently used.
+    """
+    entry = Path(cache_dir).joinpath(f"{key}.npz")
+    try:
+        with np.load(entry, allow_pickle=False) as z:
+            arrays = {k:z[k] for k in z.files}
+        os.utime(entry)
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+    return arrays
+
+def store_cached(cache_dir:Path, key:str, arrays:dict):
+    """
+    Atomically store a dict of numpy arrays for a key. Arrays must not need
+    pickling (ie no object arrays) so they can be loaded safely.
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    entry = cache_dir.joinpath(f"{key}.npz")
+    tmp = cache_dir.joinpath(f".{key}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+    try:
+        with tmp.open("wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, entry)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return entry
+
+def evict_lru(cache_dir:Path, max_bytes:int):
+    """
+    Delete the least recently used cache entries until the total size of the
+    cache is at most max_bytes.
+
+    :@return: number of bytes freed
+    """
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for e in it:
+            if not e.name.endswith(".npz"):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, e.path))
+    total = sum(s for _,s,_ in entries)
+    freed = 0
+    for _,size,path in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        freed += size
+    return freed
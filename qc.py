@@ -0,0 +1,329 @@
+"""
+Vectorized physical range and consistency quality control for hourly station
+arrays shaped (T, F) like the USCRN vsm-*/tsoil-* columns and the ISMN
+{var}_{depth}_{sensor} station pkl data.
+
+Each test is a numpy pass over every column of a variable at once, and the
+results are packed into a single (T, F) uint8 bit mask where 0 means the
+value passed every test. Window finders can then use qc_valid to get a
+boolean mask for the tests they care about.
+"""
+import re
+import warnings
+import numpy as np
+
+## QC mask bit flags
+QC_MISSING = np.uint8(1)  ## value is NaN
+QC_RANGE = np.uint8(2)    ## value outside the physical range of the variable
+QC_RATE = np.uint8(4)     ## hourly rate of change too large (spike/jump)
+QC_FLAT = np.uint8(8)     ## value is constant for too long (stuck sensor)
+QC_DEPTH = np.uint8(16)   ## disagrees with other sensors at the same depth
+QC_FROZEN = np.uint8(32)  ## soil moisture where soil at its depth is frozen
+
+qc_names = {QC_MISSING:"missing", QC_RANGE:"range", QC_RATE:"rate",
+        QC_FLAT:"flat", QC_DEPTH:"depth", QC_FROZEN:"frozen"}
+
+## per-variable test parameters. "range" is the (min, max) valid values,
+## "max_rate" the maximum absolute change per hour, and "flat_hours" the
+## number of consecutive identical values considered a flat line at the
+## surface. Deep soil changes slowly and is reported at coarse precision, so
+## for soil variables "flat_hours" increases linearly with depth below
+## flat_ref_depth, and the flat test is skipped for sensors deeper than
+## "flat_max_depth" (m). "max_depth_diff" is the maximum absolute difference
+## from the median of other sensors of the same variable at the same depth,
+## or between the sensors of a pair.
+qc_params = {
+        ## volumetric soil moisture (m^3/m^3)
+        "vsm":{"range":(0., .6), "max_rate":.15, "flat_hours":120,
+            "flat_max_depth":.4, "max_depth_diff":.1},
+        "soilm":{"range":(0., .6), "max_rate":.15, "flat_hours":120,
+            "flat_max_depth":.4, "max_depth_diff":.1},
+        ## soil temperature (C)
+        "tsoil":{"range":(-40., 60.), "max_rate":10., "flat_hours":48,
+            "flat_max_depth":.4, "max_depth_diff":5.},
+        ## air and surface temperatures (C)
+        "temp":{"range":(-60., 60.), "max_rate":15., "flat_hours":24},
+        "tair":{"range":(-60., 60.), "max_rate":15., "flat_hours":24},
+        "sfctemp":{"range":(-60., 80.), "max_rate":25., "flat_hours":24},
+        "tsfc":{"range":(-60., 80.), "max_rate":25., "flat_hours":24},
+        }
+
+## depth (m) below which flat line durations are scaled up with depth
+flat_ref_depth = .1
+## sensors whose depths differ by less than this (m) share a depth
+depth_tol = .005
+
+## variables that are paired by depth for the frozen soil consistency test
+moisture_vars = ("vsm", "soilm")
+soil_temp_vars = ("tsoil",)
+
+def label_variable(label:str):
+    """
+    Variable name associated with a feature label, ie "vsm" for the USCRN
+    label "vsm-5" and "soilm" for the ISMN label "soilm_01_00"
+    """
+    return re.split(r"[-_]", label)[0]
+
+def label_depth(label:str):
+    """
+    Depth in meters parsed from a USCRN-style label like "tsoil-10" (cm),
+    or NaN if the label doesn't end in a depth
+    """
+    m = re.fullmatch(r"[a-z]+-(\d+)", label)
+    return np.nan if m is None else float(m.group(1))/100
+
+def range_test(x, vmin, vmax):
+    """ (T,F) boolean array of values outside of [vmin, vmax] """
+    with np.errstate(invalid="ignore"):
+        return (x < vmin) | (x > vmax)
+
+def rate_test(x, max_rate, times=None):
+    """
+    (T,F) boolean array of spikes and steps, comparing each value to the
+    previous and next valid (non-NaN) values in the same column so changes
+    across gaps are tested and scaled by the gap length. A spike is a value
+    whose changes from both neighbors exceed max_rate per hour in opposite
+    directions, and only the spike itself is flagged. Otherwise a change
+    from the previous value exceeding max_rate is a step, and only the
+    first value after the step is flagged.
+
+    :@param x: (T,F) array of values
+    :@param max_rate: maximum allowed absolute change per hour
+    :@param times: (T,) epoch times of each step; hourly steps if None
+    """
+    T,F = x.shape
+    if T < 2:
+        return np.zeros(x.shape, dtype=bool)
+    hours = np.arange(T, dtype=float) if times is None \
+            else np.asarray(times, dtype=float)/3600
+    valid = np.isfinite(x)
+    tix = np.broadcast_to(np.arange(T)[:,None], x.shape)
+    cols = np.broadcast_to(np.arange(F), x.shape)
+    ## index of the previous and next valid values strictly before/after
+    last = np.maximum.accumulate(np.where(valid, tix, -1), axis=0)
+    prev = np.concatenate([np.full((1,F), -1), last[:-1]], axis=0)
+    first = np.minimum.accumulate(np.where(valid, tix, T)[::-1], axis=0)[::-1]
+    nxt = np.concatenate([first[1:], np.full((1,F), T)], axis=0)
+    has_prev = valid & (prev >= 0)
+    has_next = valid & (nxt < T)
+    pix = np.where(has_prev, prev, 0)
+    nix = np.where(has_next, nxt, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        d_in = x - x[pix, cols]
+        d_out = x[nix, cols] - x
+        r_in = np.abs(d_in) / np.clip(hours[:,None] - hours[pix], 1e-6, None)
+        r_out = np.abs(d_out) / np.clip(hours[nix] - hours[:,None], 1e-6, None)
+        jump_in = has_prev & (r_in > max_rate)
+        jump_out = has_next & (r_out > max_rate)
+        spike = jump_in & jump_out & (np.sign(d_in) * np.sign(d_out) < 0)
+    ## the return from a spike to the previous level isn't a separate step
+    step = jump_in & ~spike & ~(has_prev & spike[pix, cols])
+    return spike | step
+
+def flat_test(x, flat_hours:int):
+    """
+    (T,F) boolean array of values belonging to a run of at least flat_hours
+    identical consecutive values. Runs are found with cumulative sums rather
+    than looping over timesteps.
+    """
+    T,F = x.shape
+    n = int(flat_hours)
+    if n < 2 or T < n:
+        return np.zeros(x.shape, dtype=bool)
+    ## NaN comparisons are False, so missing values break runs
+    same = np.diff(x, axis=0) == 0
+    csum = np.concatenate([np.zeros((1,F), dtype=np.int64),
+        np.cumsum(same, axis=0)], axis=0)
+    ## run_start[i] means x[i:i+n] are all identical
+    run_start = (csum[n-1:] - csum[:-(n-1)]) == n-1
+    ## mark all n values covered by each run start via a difference array
+    cover = np.zeros((T+1,F), dtype=np.int64)
+    cover[:T-n+1] += run_start
+    cover[n:T+1] -= run_start
+    return np.cumsum(cover, axis=0)[:T] > 0
+
+def depth_group_test(x, depths, max_diff):
+    """
+    Flag values that differ by more than max_diff from the median of all
+    sensors at the same depth, for depths with at least 3 sensors (ie the
+    ISMN {var}_{depth_ix}_* groups). The median of only 2 sensors is their
+    mean, so pairs are compared directly instead, and both are flagged when
+    they differ by more than max_diff since neither can be trusted over the
+    other.
+
+    :@param x: (T,F) array of one variable's values
+    :@param depths: (F,) sensor depths in meters
+    :@param max_diff: maximum absolute difference from the depth median, or
+        between the two sensors of a pair
+    """
+    out = np.zeros(x.shape, dtype=bool)
+    depths = np.asarray(depths, dtype=float)
+    m_depth = np.isfinite(depths)
+    if np.count_nonzero(m_depth) < 2:
+        return out
+    ## group sensors whose depths round to the same depth_tol bin
+    dbins = np.round(depths / depth_tol)
+    for d in np.unique(dbins[m_depth]):
+        gixs = np.where(dbins == d)[0]
+        if gixs.size < 2:
+            continue
+        g = x[:,gixs]
+        if gixs.size == 2:
+            ## NaN differences compare False, so both values must be valid
+            with np.errstate(invalid="ignore"):
+                pair = np.abs(g[:,0] - g[:,1]) > max_diff
+            out[:,gixs] = pair[:,None]
+            continue
+        ## median needs at least 2 valid sensors at a timestep to compare
+        m_enough = np.count_nonzero(np.isfinite(g), axis=1) >= 2
+        ## all-NaN timesteps warn in nanmedian but are masked by m_enough
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med = np.nanmedian(g, axis=1)
+            out[:,gixs] = m_enough[:,None] & \
+                    (np.abs(g - med[:,None]) > max_diff)
+    return out
+
+def frozen_test(moisture, temperature, m_depths, t_depths, depth_tol=.03):
+    """
+    Flag soil moisture values when the soil temperature at the nearest depth
+    (within depth_tol meters) is below freezing, since dielectric sensors
+    misreport liquid water content in frozen soil.
+
+    :@param moisture: (T,Fm) soil moisture array
+    :@param temperature: (T,Ft) soil temperature array on the same time axis
+    :@param m_depths: (Fm,) soil moisture sensor depths (m)
+    :@param t_depths: (Ft,) soil temperature sensor depths (m)
+
+    :@return: (T,Fm) boolean array of flagged moisture values
+    """
+    out = np.zeros(moisture.shape, dtype=bool)
+    m_depths = np.asarray(m_depths, dtype=float)
+    t_depths = np.asarray(t_depths, dtype=float)
+    if temperature.shape[-1]==0 or moisture.shape[-1]==0:
+        return out
+    ## (Fm,Ft) depth differences; NaN depths never match
+    ddiff = np.abs(m_depths[:,None] - t_depths[None,:])
+    ddiff = np.where(np.isfinite(ddiff), ddiff, np.inf)
+    pair = np.argmin(ddiff, axis=1)
+    has_pair = ddiff[np.arange(m_depths.size), pair] <= depth_tol
+    with np.errstate(invalid="ignore"):
+        frozen = temperature[:,pair] < 0.
+    out[:,has_pair] = frozen[:,has_pair]
+    return out
+
+def _depth_flat_test(x, depths, params):
+    """
+    Flat line test running flat_test once per distinct duration. For soil
+    variables (those with "flat_max_depth") the duration is scaled by depth
+    below ground and sensors deeper than flat_max_depth are excluded; other
+    variables and sensors at or above ground use the plain flat_hours.
+    """
+    out = np.zeros(x.shape, dtype=bool)
+    depths = np.asarray(depths, dtype=float)
+    hours = np.full(depths.shape, int(params["flat_hours"]))
+    if "flat_max_depth" in params.keys():
+        ## NaN and non-positive depths aren't in the soil, so aren't scaled
+        with np.errstate(invalid="ignore"):
+            m_soil = depths > 0
+        hours[m_soil] = np.round(params["flat_hours"] * np.maximum(
+            1., depths[m_soil]/flat_ref_depth)).astype(int)
+        hours[m_soil & (depths > params["flat_max_depth"])] = 0
+    for n in np.unique(hours[hours > 0]):
+        fixs = np.where(hours == n)[0]
+        out[:,fixs] = flat_test(x[:,fixs], n)
+    return out
+
+def qc_station(data, labels:list, depths=None, times=None, params=qc_params):
+    """
+    Run every applicable QC test on a station's (T,F) data array, grouping
+    columns by variable so each test is a single vectorized pass.
+
+    :@param data: (T,F) float array of hourly station data
+    :@param labels: F feature labels used to determine each column's variable
+    :@param depths: (F,) sensor depths in meters (NaN for non-soil features).
+        If None, depths are parsed from USCRN-style labels.
+    :@param times: Optional (T,) epoch times used to scale the rate test
+    :@param params: dict mapping variable names to test parameters
+
+    :@return: (T,F) uint8 QC bit mask, with 0 where all tests passed
+    """
+    data = np.asarray(data, dtype=float)
+    if depths is None:
+        depths = [label_depth(l) for l in labels]
+    depths = np.asarray(depths, dtype=float)
+    mask = np.zeros(data.shape, dtype=np.uint8)
+    mask[np.isnan(data)] |= QC_MISSING
+
+    variables = np.array([label_variable(l) for l in labels])
+    for v in np.unique(variables):
+        if v not in params.keys():
+            continue
+        vixs = np.where(variables==v)[0]
+        x = data[:,vixs]
+        p = params[v]
+        m = np.zeros(x.shape, dtype=np.uint8)
+        if "range" in p.keys():
+            m[range_test(x, *p["range"])] |= QC_RANGE
+        if "max_rate" in p.keys():
+            m[rate_test(x, p["max_rate"], times)] |= QC_RATE
+        if "flat_hours" in p.keys():
+            m[:,:] |= np.where(_depth_flat_test(x, depths[vixs], p),
+                    QC_FLAT, np.uint8(0))
+        if "max_depth_diff" in p.keys():
+            m[depth_group_test(x, depths[vixs], p["max_depth_diff"])] |= \
+                    QC_DEPTH
+        mask[:,vixs] |= m
+
+    ## frozen soil consistency between soil moisture and soil temperature
+    mixs = np.where(np.isin(variables, moisture_vars))[0]
+    tixs = np.where(np.isin(variables, soil_temp_vars))[0]
+    if mixs.size and tixs.size:
+        frozen = frozen_test(data[:,mixs], data[:,tixs],
+                depths[mixs], depths[tixs])
+        mask[:,mixs] |= np.where(frozen, QC_FROZEN, np.uint8(0))
+    return mask
+
+def qc_valid(qc_mask, ignore:int=0):
+    """
+    Boolean mask of values that passed QC, optionally ignoring some tests
+
+    :@param qc_mask: uint8 QC bit mask from qc_station
+    :@param ignore: bitwise OR of QC flags that shouldn't invalidate values
+    """
+    return (qc_mask & np.uint8(~ignore & 0xff)) == 0
+
+def qc_summary(qc_mask, labels:list):
+    """
+    dict mapping each label to the count of values failing each test
+    """
+    return {l:{n:int(np.count_nonzero(qc_mask[:,i] & b))
+        for b,n in qc_names.items()} for i,l in enumerate(labels)}
+
+def valid_window_starts(m_valid, window_size:int, m_contig=None):
+    """
+    Vectorized search for initial indices of windows where all data are valid,
+    matching the loop used by the extract_* scripts: index ix is returned if
+    m_contig[ix:ix+window_size] and m_valid[ix:ix+window_size+1] are all True.
+
+    :@param m_valid: (T,) boolean mask of timesteps with all required data
+    :@param window_size: number of contiguous steps that must follow ix
+    :@param m_contig: (T-1,) boolean mask of steps that are contiguous in time
+        with the next step. Assumed all True if not provided.
+
+    :@return: integer array of valid initial indices
+    """
+    m_valid = np.asarray(m_valid, dtype=bool)
+    if m_contig is None:
+        m_contig = np.ones(m_valid.size-1, dtype=bool)
+    m_contig = np.asarray(m_contig, dtype=bool)
+    w = int(window_size)
+    nstarts = m_contig.size - w
+    if nstarts <= 0:
+        return np.zeros(0, dtype=np.int64)
+    cs_c = np.concatenate([[0], np.cumsum(m_contig)])
+    cs_v = np.concatenate([[0], np.cumsum(m_valid)])
+    ix = np.arange(nstarts)
+    ok_c = (cs_c[ix+w] - cs_c[ix]) == w
+    ok_v = (cs_v[ix+w+1] - cs_v[ix]) == w+1
+    return np.where(ok_c & ok_v)[0]
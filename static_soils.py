@@ -0,0 +1,192 @@
+"""
+Build tables of static (time-invariant) soil properties indexed by station,
+so that time series samples only need to carry an integer station index
+rather than duplicating the static features into every (N, W, F) sample.
+
+A static table is a dict with the keys:
+    "ids":    list of S string station keys, ie "uscrn_al_fairhope-3-ne"
+    "index":  dict mapping each station key to its row in the data array
+    "labels": list of F string feature labels
+    "data":   (S, F) float array of static features, NaN where unavailable
+    "strdata":(S, Fs) list of string-valued station properties
+    "strlabels": list of Fs string feature labels
+"""
+import re
+import csv
+import pickle as pkl
+from pathlib import Path
+import numpy as np
+
+## string-valued columns in the USCRN soil property csv
+uscrn_str_fields = ["state", "locale", "vegetation", "soil-class"]
+
+## ISMN station_meta soil properties to retain as static features
+ismn_soil_fields = ["clay_fraction", "sand_fraction", "silt_fraction",
+        "organic_carbon", "saturation"]
+ismn_str_fields = ["climate_KG", "climate_insitu"]
+
+def normalize_locale(locale:str):
+    """
+    Convert a USCRN locale name into the hyphenated lowercase form used by the
+    station file naming, for example both "Fairhope 3NE" (csv) and
+    "Fairhope_3_NE" (text file stem) become "fairhope-3-ne"
+
+    :@param locale: Locale string in any of the USCRN spellings
+    """
+    locale = locale.lower().replace(".","")
+    ## separate distance numbers from direction suffixes like "3ne"
+    locale = re.sub(r"(\d)([a-z])", r"\1 \2", locale)
+    return "-".join(p for p in re.split(r"[\s_\-]+", locale) if p)
+
+def uscrn_station_key(state:str, locale:str):
+    """
+    Station key matching the uscrn_{state}_{locale} pkl file naming
+    """
+    return f"uscrn_{state.lower()}_{normalize_locale(locale)}"
+
+def uscrn_key_from_path(pkl_path:Path):
+    """
+    Station key for a yearly or combined USCRN pkl, ie a path named
+    uscrn_{state}_{locale}_{years}.pkl
+    """
+    return "_".join(Path(pkl_path).stem.split("_")[:3])
+
+def ismn_station_key(network:str, station:str):
+    """
+    Station key matching the station_{network}_{station} ISMN pkl naming
+    """
+    network = network.replace(".","")
+    station = station.replace(".","")
+    return f"ismn_{network}_{station}"
+
+def _make_table(ids, labels, data, strlabels, strdata):
+    """ Assemble a static table dict, ensuring station keys are unique """
+    index = {}
+    for i,k in enumerate(ids):
+        if k in index.keys():
+            raise ValueError(f"Duplicate static station key: {k}")
+        index[k] = i
+    return {
+            "ids":list(ids),
+            "index":index,
+            "labels":list(labels),
+            "data":np.asarray(data, dtype=np.float32).reshape(
+                len(ids), len(labels)),
+            "strlabels":list(strlabels),
+            "strdata":[list(s) for s in strdata],
+            }
+
+def load_uscrn_soils(csv_path:Path):
+    """
+    Parse the USCRN per-depth soil texture, wilting point, and field capacity
+    csv into a static table keyed by uscrn_{state}_{locale}
+
+    :@param csv_path: Path to data/uscrn-station-soils.csv
+    """
+    ## the csv is written with a byte order mark before the first label
+    rows = list(csv.reader(Path(csv_path).open("r", encoding="utf-8-sig")))
+    header,rows = rows[0],[r for r in rows[1:] if any(r)]
+    flabels = [h for h in header if h not in uscrn_str_fields]
+    fixs = [header.index(h) for h in flabels]
+    sixs = [header.index(h) for h in uscrn_str_fields]
+    ids,data,strdata = [],[],[]
+    for r in rows:
+        r = r + [""]*(len(header)-len(r))
+        ids.append(uscrn_station_key(
+            r[header.index("state")], r[header.index("locale")]))
+        data.append([float(r[i]) if r[i].strip() else np.nan for i in fixs])
+        strdata.append([r[i] for i in sixs])
+    return _make_table(ids, flabels, data, uscrn_str_fields, strdata)
+
+def _ismn_meta_value(meta_entry):
+    """
+    Return the shallowest value of an ISMN metadata entry, which is stored
+    as a list of (value, depth_from, depth_to) records per variable
+    """
+    if meta_entry is None:
+        return None
+    if not isinstance(meta_entry, (list, tuple)):
+        return meta_entry
+    if len(meta_entry)==0:
+        return None
+    ## a single (value, d0, df) record rather than a list of them
+    if not isinstance(meta_entry[0], (list, tuple)):
+        return meta_entry[0]
+    recs = sorted(meta_entry, key=lambda r:(
+        np.inf if len(r)<2 or r[1] is None else r[1]))
+    return recs[0][0]
+
+def load_ismn_soils(station_pkl_dir:Path):
+    """
+    Collect the soil fraction and climate metadata from every ISMN station
+    pkl generated by extract_ismn into a static table keyed by
+    ismn_{network}_{station}. Location (lat, lon, elev) is included as well.
+
+    :@param station_pkl_dir: directory of station_{network}_{station}.pkl
+    """
+    flabels = ["lat", "lon", "elev"] + ismn_soil_fields
+    ids,data,strdata = [],[],[]
+    for p in sorted(Path(station_pkl_dir).glob("station_*.pkl")):
+        sd = pkl.load(p.open("rb"))
+        meta = sd["station_meta"]
+        vals = list(sd["location"])
+        for k in ismn_soil_fields:
+            v = _ismn_meta_value(meta.get(k))
+            try:
+                vals.append(float(v))
+            except (TypeError, ValueError):
+                vals.append(np.nan)
+        ids.append(ismn_station_key(sd["network"], sd["station"]))
+        data.append(vals)
+        strdata.append([str(_ismn_meta_value(meta.get(k)))
+            for k in ismn_str_fields])
+    return _make_table(ids, flabels, data, ismn_str_fields, strdata)
+
+def station_indices(table:dict, station_keys:list, missing=-1):
+    """
+    Map a sequence of station keys to their row indices in a static table,
+    using the provided value for stations that aren't in the table
+
+    :@return: (N,) integer array of static table row indices
+    """
+    return np.asarray([table["index"].get(k, missing) for k in station_keys],
+            dtype=np.int64)
+
+def gather_static(table:dict, static_ixs, window_size:int=None, feats=None):
+    """
+    Vectorized gather of static features for a batch of samples. Samples
+    with a negative station index (missing from the table) are NaN-filled.
+
+    :@param table: static table dict from load_uscrn_soils/load_ismn_soils
+    :@param static_ixs: (B,) integer station indices, one per sample
+    :@param window_size: If provided, the (B, F) result is lazily broadcast
+        along a new time axis to a read-only (B, W, F) view without copying
+    :@param feats: Optional subset of feature labels to return, in order
+
+    :@return: (B, F) or (B, W, F) array of static features
+    """
+    static_ixs = np.asarray(static_ixs)
+    data = table["data"]
+    if feats is not None:
+        data = data[:,[table["labels"].index(f) for f in feats]]
+    ## append a NaN row so that index -1 selects missing values
+    data = np.concatenate([data, np.full((1,data.shape[1]), np.nan,
+        dtype=data.dtype)], axis=0)
+    out = data[np.where(static_ixs<0, data.shape[0]-1, static_ixs)]
+    if window_size is not None:
+        out = np.broadcast_to(out[...,None,:],
+                (*out.shape[:-1], window_size, out.shape[-1]))
+    return out
+
+if __name__=="__main__":
+    proj_root_dir = Path("/rhome/mdodson/soil-in-situ")
+    uscrn_soils_csv = proj_root_dir.joinpath("data/uscrn-station-soils.csv")
+    ismn_pkl_dir = Path("/rstor/mdodson/in-situ/ismn/station-pkls")
+    static_pkl = proj_root_dir.joinpath("data/static_soils.pkl")
+
+    tables = {"uscrn":load_uscrn_soils(uscrn_soils_csv)}
+    if ismn_pkl_dir.exists():
+        tables["ismn"] = load_ismn_soils(ismn_pkl_dir)
+    for k,t in tables.items():
+        print(f"{k}: {len(t['ids'])} stations, {len(t['labels'])} features")
+    pkl.dump(tables, static_pkl.open("wb"))
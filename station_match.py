@@ -0,0 +1,364 @@
+"""
+Match stations that appear in more than one source (ISMN, the SCAN REST API,
+and USCRN) by location, elevation, and name, and determine the time ranges
+that each station's data is already available locally across all of its
+duplicates, so that downloads can be limited to the gaps.
+
+A station index is a dict of equal-length per-station arrays/lists:
+    "source":   "ismn", "scan", or "uscrn"
+    "ids":      unique key per source, ie ismn_{network}_{station},
+                the SCAN station triplet, or uscrn_{state}_{locale}
+    "names":    normalized station name used for id matching
+    "lat","lon","elev": float arrays (degrees, degrees, meters)
+    "coverage": dict mapping SCAN REST element codes (ie "SMS", "PRCP") to
+                lists of [(t0, t1), ...] epoch ranges available locally
+
+Coverage is tracked per SCAN element so a duplicate station only removes
+the elements that its source actually provides. SCAN coverage also includes
+every range already requested from the REST API (see get_scan's request
+log), so ranges that came back empty aren't requested again. Elements are compared by
+code only, so a duplicate with soil moisture at some depths is considered
+to cover soil moisture at all depths.
+"""
+import re
+import pickle as pkl
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+
+from static_soils import ismn_station_key,uscrn_key_from_path
+
+earth_radius_km = 6371.0
+feet_to_meters = .3048
+
+## SCAN REST element codes supplied by each ISMN variable
+ismn_elements = {
+        "soil_moisture":"SMS", "soil_temperature":"STO",
+        "precipitation":"PRCP", "air_temperature":"TAVG",
+        "snow_depth":"SNWD", "snow_water_equivalent":"WTEQ",
+        }
+## ISMN variable label prefixes, matching var_mapping in extract_ismn
+ismn_var_prefixes = {
+        "snow_depth":"snod", "surface_temperature":"tsfc",
+        "precipitation":"prcp", "soil_temperature":"tsoil",
+        "air_temperature":"tair", "soil_moisture":"soilm",
+        "snow_water_equivalent":"swe",
+        }
+## SCAN REST element codes supplied by each USCRN field prefix
+uscrn_elements = {
+        "vsm":"SMS", "tsoil":"STO", "temp":"TAVG", "precip":"PRCP",
+        "rh":"RHUMV", "dswrf":"SRADV",
+        }
+
+def normalize_name(name:str):
+    """ Lowercase alphanumeric form of a station name for comparison """
+    return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+def merge_ranges(ranges:list):
+    """ Merge a list of (t0, t1) ranges into sorted non-overlapping ranges """
+    merged = []
+    for t0,t1 in sorted(r for r in ranges if r[1] >= r[0]):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], t1))
+        else:
+            merged.append((t0, t1))
+    return merged
+
+def uncovered_ranges(begin:int, end:int, covered:list, min_gap:int=86400):
+    """
+    Sub-ranges of [begin, end] that aren't within any covered range
+
+    :@param begin: epoch time of the start of the requested range
+    :@param end: epoch time of the end of the requested range
+    :@param covered: list of (t0, t1) epoch ranges that are already available
+    :@param min_gap: gaps shorter than this many seconds are ignored
+
+    :@return: list of (t0, t1) epoch ranges that still need to be acquired
+    """
+    gaps = []
+    cur = begin
+    for t0,t1 in merge_ranges(covered):
+        if t1 < cur:
+            continue
+        if t0 > end:
+            break
+        if t0 - cur >= min_gap:
+            gaps.append((cur, t0))
+        cur = max(cur, t1)
+    if end - cur >= min_gap:
+        gaps.append((cur, end))
+    return gaps
+
+def time_runs(etimes, max_step:int=7200):
+    """
+    Observed (t0, t1) ranges of sorted epoch times, splitting wherever
+    consecutive times are more than max_step seconds apart
+    """
+    etimes = np.asarray(etimes)
+    if etimes.size == 0:
+        return []
+    breaks = np.where(np.diff(etimes) > max_step)[0]
+    starts = np.concatenate([[0], breaks+1])
+    ends = np.concatenate([breaks, [etimes.size-1]])
+    return [(int(etimes[a]), int(etimes[b])) for a,b in zip(starts,ends)]
+
+def _merge_coverage(coverage:dict, element:str, ranges:list):
+    """ Add ranges to an element of a coverage dict in place """
+    if element is None or len(ranges)==0:
+        return
+    coverage[element] = merge_ranges(coverage.get(element, []) + ranges)
+
+def ismn_pkl_coverage(station_pkl:dict, var_mapping:dict=ismn_var_prefixes):
+    """
+    Per-element observed ranges of a station pkl generated by extract_ismn,
+    using the hours where any sensor of each variable has a valid value
+
+    :@param station_pkl: dict loaded from a station_{network}_{station}.pkl
+    :@param var_mapping: ISMN variable name to label prefix mapping used when
+        the pkl was generated, ie {"soil_moisture":"soilm", ...}
+    """
+    times = station_pkl["times"]
+    if len(times)==0:
+        return {}
+    t0 = int(datetime.strptime(times[0], "%Y%m%d%H").strftime("%s"))
+    etimes = t0 + 3600*np.arange(len(times))
+    data = station_pkl["data"][:len(times)]
+    prefixes = np.array([l.split("_")[0] for l in station_pkl["labels"]])
+    coverage = {}
+    for ivar,vk in var_mapping.items():
+        fixs = np.where(prefixes == vk)[0]
+        if fixs.size == 0:
+            continue
+        m_valid = np.any(np.isfinite(data[:,fixs]), axis=1)
+        _merge_coverage(coverage, ismn_elements.get(ivar),
+                time_runs(etimes[m_valid]))
+    return coverage
+
+def ismn_stations(ismn_dm:dict, networks:list=None,
+        station_pkl_dir:Path=None, var_mapping:dict=ismn_var_prefixes):
+    """
+    Station records from the ISMN data menu json generated by extract_ismn.
+
+    Coverage is observed per element from the station pkl if station_pkl_dir
+    is provided and the pkl exists. Otherwise, each sensor
+    variable is assumed to cover the station's whole (min, max) time_range,
+    which ignores any gaps within that range.
+
+    :@param ismn_dm: dict {network:{station:{"location", "time_range", ...}}}
+    :@param networks: Optional subset of network names to include
+    :@param station_pkl_dir: Optional directory of extract_ismn station pkls
+    :@param var_mapping: ISMN variable to label prefix mapping of the pkls
+    """
+    recs = []
+    for ntw,stations in ismn_dm.items():
+        if networks is not None and ntw not in networks:
+            continue
+        for stn,sd in stations.items():
+            lat,lon,elev = sd["location"]
+            pkl_path = None
+            if station_pkl_dir is not None:
+                pkl_path = Path(station_pkl_dir).joinpath(
+                    f"station_{ntw.replace('.','')}_{stn.replace('.','')}.pkl")
+            coverage = {}
+            if pkl_path is not None and pkl_path.exists():
+                coverage = ismn_pkl_coverage(
+                        pkl.load(pkl_path.open("rb")), var_mapping)
+            else:
+                t0,t1 = sd.get("time_range", (None, None))
+                if t0 is not None and t1 is not None:
+                    for ssr in sd.get("sensors", []):
+                        _merge_coverage(coverage,
+                                ismn_elements.get(ssr["variable"]), [(t0,t1)])
+            recs.append({
+                "source":"ismn",
+                "id":ismn_station_key(ntw, stn),
+                "name":normalize_name(stn),
+                "lat":lat, "lon":lon, "elev":elev,
+                "coverage":coverage,
+                })
+    return recs
+
+def scan_rest_stations(smenu:dict, scan_pkl_dir:Path=None,
+        request_log:dict=None, network="SCAN"):
+    """
+    Station records from the SCAN REST API station menu, with per-element
+    coverage observed in any scandata_{triplet}.pkl already downloaded by
+    get_scan, plus any ranges previously requested for the station
+
+    :@param smenu: dict mapping station triplets to REST station dicts
+    :@param scan_pkl_dir: Optional directory of downloaded station pkls
+    :@param request_log: Optional dict mapping station triplets to dicts of
+        element codes and lists of [t0, t1] ranges that were requested,
+        regardless of whether any data was returned
+    :@param network: REST networkCode to include
+    """
+    recs = []
+    for triplet,sd in smenu.items():
+        if sd["networkCode"] != network:
+            continue
+        coverage = {}
+        if scan_pkl_dir is not None:
+            pkl_path = Path(scan_pkl_dir).joinpath(
+                    f"scandata_{triplet.replace(':','-')}.pkl")
+            if pkl_path.exists():
+                coverage = scan_pkl_coverage(pkl.load(pkl_path.open("rb")))
+        if request_log is not None:
+            for element,ranges in request_log.get(triplet, {}).items():
+                _merge_coverage(coverage, element, [tuple(r) for r in ranges])
+        recs.append({
+            "source":"scan",
+            "id":triplet,
+            "name":normalize_name(sd["name"]),
+            "lat":sd["latitude"], "lon":sd["longitude"],
+            "elev":sd.get("elevation", np.nan) * feet_to_meters,
+            "coverage":coverage,
+            })
+    return recs
+
+def scan_element_ranges(station:dict, duration="HOURLY"):
+    """
+    Per-element period of record of a REST station dict requested with
+    returnStationElements, or None if the station dict has no element list
+
+    :@param station: station dict from get_scan.get_stations_menu
+    :@param duration: only include elements reported at this duration
+    """
+    if "stationElements" not in station.keys():
+        return None
+    parse = lambda d,default:default if not d else \
+            int(datetime.strptime(d, "%Y-%m-%d %H:%M").strftime("%s"))
+    ranges = {}
+    for se in station["stationElements"] or []:
+        if se.get("durationName", duration).upper() != duration.upper():
+            continue
+        ranges[se["elementCode"]] = merge_ranges(
+                ranges.get(se["elementCode"], []) + [(
+                    parse(se.get("beginDate"), 0),
+                    parse(se.get("endDate"), np.iinfo(np.int64).max),
+                    )])
+    return ranges
+
+def scan_pkl_coverage(sdata:dict):
+    """
+    Per-element observed ranges of a station dict from get_station_data,
+    where keys are formatted {elementCode}:{heightDepth}:{ordinal}
+    """
+    coverage = {}
+    for k,d in sdata.items():
+        m_valid = np.isfinite(np.asarray(d["data"], dtype=float))
+        etimes = np.sort(np.asarray(d["etimes"])[m_valid])
+        _merge_coverage(coverage, k.split(":")[0], time_runs(etimes))
+    return coverage
+
+def uscrn_pkl_coverage(combined_pkl:dict):
+    """
+    Per-element observed ranges of a combined USCRN pkl from extract_uscrn
+    """
+    etimes = np.asarray(combined_pkl["utc-datetime"])
+    coverage = {}
+    for k,v in combined_pkl.items():
+        element = uscrn_elements.get(k.split("-")[0])
+        if element is None:
+            continue
+        m_valid = np.isfinite(np.asarray(v, dtype=float))
+        _merge_coverage(coverage, element, time_runs(etimes[m_valid]))
+    return coverage
+
+def uscrn_stations(static_table:dict, combined_pkl_dir:Path=None):
+    """
+    Station records from the USCRN static soil table (see static_soils), with
+    per-element coverage observed in any uscrn_{state}_{locale}_{years}.pkl
+    combined files generated by extract_uscrn
+
+    :@param static_table: table from static_soils.load_uscrn_soils
+    :@param combined_pkl_dir: Optional directory of combined station pkls
+    """
+    coverages = {}
+    if combined_pkl_dir is not None:
+        for p in Path(combined_pkl_dir).glob("uscrn_*.pkl"):
+            coverages[uscrn_key_from_path(p)] = uscrn_pkl_coverage(
+                    pkl.load(p.open("rb")))
+    ilat,ilon,ielev = map(static_table["labels"].index, ["lat","lon","elev"])
+    iloc = static_table["strlabels"].index("locale")
+    recs = []
+    for i,k in enumerate(static_table["ids"]):
+        recs.append({
+            "source":"uscrn",
+            "id":k,
+            "name":normalize_name(static_table["strdata"][i][iloc]),
+            "lat":static_table["data"][i,ilat],
+            "lon":static_table["data"][i,ilon],
+            "elev":static_table["data"][i,ielev],
+            "coverage":coverages.get(k, {}),
+            })
+    return recs
+
+def build_station_index(*record_lists):
+    """
+    Combine lists of station records from any of the sources into a single
+    station index dict of arrays
+    """
+    recs = [r for rl in record_lists for r in rl]
+    farr = lambda k:np.asarray([np.nan if r[k] is None else r[k]
+        for r in recs], dtype=float)
+    index = {
+            "source":np.asarray([r["source"] for r in recs]),
+            "ids":[r["id"] for r in recs],
+            "names":np.asarray([r["name"] for r in recs]),
+            "lat":farr("lat"),
+            "lon":farr("lon"),
+            "elev":farr("elev"),
+            "coverage":[dict(r["coverage"]) for r in recs],
+            }
+    index["ix"] = {(s,k):i for i,(s,k) in enumerate(
+        zip(index["source"], index["ids"]))}
+    return index
+
+def station_distances(index:dict):
+    """ (S,S) great-circle distances (km) between all stations """
+    lat = np.deg2rad(index["lat"])
+    lon = np.deg2rad(index["lon"])
+    dlat = lat[:,None] - lat[None,:]
+    dlon = lon[:,None] - lon[None,:]
+    a = np.sin(dlat/2)**2 + \
+            np.cos(lat[:,None]) * np.cos(lat[None,:]) * np.sin(dlon/2)**2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def match_stations(index:dict, max_km:float=1., max_elev_m:float=50.,
+        name_max_km:float=10.):
+    """
+    Identify duplicate stations across different sources. Two stations match
+    if they are within max_km and max_elev_m of each other (unknown elevation
+    is ignored), or if their normalized names are identical and they are
+    within name_max_km, which tolerates coarsely reported coordinates.
+
+    :@return: (S,S) boolean matrix where [i,j] is True if station i and
+        station j from a different source are duplicates
+    """
+    dist = station_distances(index)
+    dz = np.abs(index["elev"][:,None] - index["elev"][None,:])
+    m_elev = np.isnan(dz) | (dz <= max_elev_m)
+    m_near = (dist <= max_km) & m_elev
+    m_name = (index["names"][:,None] == index["names"][None,:]) & \
+            (index["names"][:,None] != "") & (dist <= name_max_km)
+    m_other = index["source"][:,None] != index["source"][None,:]
+    return (m_near | m_name) & m_other
+
+def covered_ranges(index:dict, matches, station_ix:int, element:str,
+        duplicates:bool=True):
+    """
+    Merged local time coverage of one element at a station and all of its
+    duplicates
+
+    :@param index: station index from build_station_index
+    :@param matches: (S,S) boolean matrix from match_stations
+    :@param station_ix: index of the station in the station index
+    :@param element: SCAN REST element code, ie "SMS"
+    :@param duplicates: If False, only the station's own coverage is used,
+        for elements that must be present in the station's own data
+    """
+    dups = [station_ix]
+    if duplicates:
+        dups += list(np.where(matches[station_ix])[0])
+    return merge_ranges([r for i in dups
+        for r in index["coverage"][i].get(element, [])])